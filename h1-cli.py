@@ -1,43 +1,51 @@
 
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
 from pathlib import Path
-import pickle
 from pprint import pprint
-import sys
-from tempfile import TemporaryDirectory
 
-import bugzilla
 import click
-import rich
 from rich.console import Console
 from rich.markdown import Markdown
-from rich.progress import Progress
 from rich.prompt import Prompt
-from rich.table import Table
 
 import h1lib
 
 
+def _get_api_key(ctx):
+    # Only ask for the HackerOne API key when a command needs it, H1_API_KEY skips the prompt entirely
+    if "h1_api_key" not in ctx.obj:
+        h1_key_username = ctx.parent.params["h1_key_username"]
+        ctx.obj["h1_api_key"] = os.environ.get("H1_API_KEY") or Prompt.ask(
+            prompt=f"What is the HackerOne API key for {h1_key_username}", console=ctx.obj["console"])
+    return ctx.obj["h1_api_key"]
+
+
+def _upload_attachment(bzapi, bug_id, attachment_obj, attachment_save_path):
+    # Open file and attach it to the bug
+    with open(attachment_save_path, 'rb') as f:
+        return bzapi.attachfile(idlist=[bug_id], attachfile=f, description=attachment_obj.file_name)
+
+
 @click.group("h1-cli")
 @click.option("-h1u", "--h1-key-username", help="HackerOne API key name", type=click.STRING, required=True,
               default="scott_f_bmo_exporter")
 @click.option("--cache", help="Cache reports when possible", is_flag=True, default=False, show_default=False)
-@click.option("--cache-path", help="Where the cache should be saved", default="/tmp/h1_cache",
-              show_default=True, type=click.Path(dir_okay=False, writable=True, resolve_path=True))
+@click.option("--cache-path", help="Directory where the cache should be saved", default="/tmp/h1_cache.d",
+              show_default=True, type=click.Path(file_okay=False, writable=True, resolve_path=True))
 @click.pass_context
 def h1_cli(ctx, h1_key_username, cache, cache_path):
     # Rich console output for pretty printing
     # Switch 'quiet' to True to suppress all output. Defaults to False.
     # Add Rich Console to the context obj
     ctx.obj = {"console": Console(quiet=False)}
-    console = ctx.obj["console"]
 
-    h1_api_key = Prompt.ask(prompt=f"What is the HackerOne API key for {h1_key_username}", console=console)
     # Local cache path for dev work
     local_cache_path = Path(cache_path)
 
     # Update the context object provided by Click with global variables
-    ctx.obj.update({"h1_api_key": h1_api_key, "local_cache_path": local_cache_path})
+    ctx.obj.update({"local_cache_path": local_cache_path})
 
 @h1_cli.command("show")
 @click.argument("h1-report-id", type=click.INT)
@@ -49,7 +57,7 @@ def h1_exporter(ctx, h1_report_id, markdown):
     Print H1 report to screen with the correct formatting
     """
     console: Console = ctx.obj["console"]
-    h1_api_key = ctx.obj["h1_api_key"]
+    h1_api_key = _get_api_key(ctx)
     local_cache_path = ctx.obj["local_cache_path"]
     cache = ctx.parent.params["cache"]
     h1_key_username = ctx.parent.params["h1_key_username"]
@@ -72,8 +80,13 @@ def h1_exporter(ctx, h1_report_id, markdown):
 @click.pass_context
 def upload_bmo(ctx, h1_report_id, bugzilla_url):
     """Upload a HackerOne report to Bugzilla"""
+    # Only this command needs these, importing them here keeps the other commands quick to start
+    from tempfile import TemporaryDirectory
+
+    import bugzilla
+
     console: Console = ctx.obj["console"]
-    h1_api_key = ctx.obj["h1_api_key"]
+    h1_api_key = _get_api_key(ctx)
     local_cache_path = ctx.obj["local_cache_path"]
     h1_key_username = ctx.parent.params["h1_key_username"]
     cache = ctx.parent.params["cache"]
@@ -99,14 +112,13 @@ def upload_bmo(ctx, h1_report_id, bugzilla_url):
         tmpdirname_path = Path(tmpdirname)
         tmpdirname_path.mkdir(exist_ok=True)
 
-        # Each attachment gets downloaded
-        for attachment_obj in attachments_list:
-            # Download each attachment and save it to disk
-            attachment_save_path = attachment_obj.download_attachment(save_dir_path=tmpdirname_path)
+        # Download all attachments at once and save them to disk
+        attachment_save_paths = h1lib.download_attachments(attachments_list, save_dir_path=tmpdirname_path)
 
-            # Open file and attach it to the bug
-            with open(attachment_save_path, 'rb') as f:
-                resp = bzapi.attachfile(idlist=[new_bug.id], attachfile=f, description=attachment_obj.file_name)
+        # Upload them in parallel, each upload mostly waits on the Bugzilla server. Bugzilla lists attachments in the
+        # order the uploads finish, so they may not follow the order of the HackerOne comments.
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(partial(_upload_attachment, bzapi, new_bug.id), attachments_list, attachment_save_paths))
     pprint(f"{h1lib.success_msg} Uploaded attachments to bug: {new_bug.weburl}")
 
 
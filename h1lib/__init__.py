@@ -9,17 +9,31 @@ username = "YOUR_USER_NAME"
 token = "GENERATE_AN_API_TOKEN_THROUGH_HACKERONE_WEBSITE"
 session = HackerOneSession(username, token)
 """
-import pickle
+import os
+import random
 import sys
-from dataclasses import dataclass
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from time import sleep
-from typing import Optional, Set
+from threading import Lock
+from time import monotonic, sleep, time
+from typing import Iterable, List, Optional, Set
+from urllib.parse import parse_qs, urlparse
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from rich.pretty import pprint
+from urllib3.util import Retry
+
+try:
+    # Optional C parser for the timestamps in API responses
+    import ciso8601
+except ImportError:
+    ciso8601 = None
 
 error_msg = f"[bold][white][[red]![/red][white]][/white][/bold]"
 success_msg = f"[bold][white][[green]*[/green][white]][/white][/bold]"
@@ -36,6 +50,54 @@ class Utils:
             num /= 1024.0
         return f"{num:.1f}Yi{suffix}"
 
+    @staticmethod
+    def parse_datetime(timestamp: str) -> datetime:
+        # Parse an ISO 8601 timestamp, keeping the timezone
+        if ciso8601:
+            return ciso8601.parse_datetime(timestamp)
+        # fromisoformat only accepts a trailing 'Z' from Python 3.11 on
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+    @staticmethod
+    def parse_naive_datetime(timestamp: str) -> datetime:
+        # Parse an ISO 8601 timestamp, dropping the trailing 'Z' timezone
+        if ciso8601:
+            return ciso8601.parse_datetime_as_naive(timestamp)
+        return datetime.fromisoformat(timestamp.rstrip("Z"))
+
+
+class RateLimiter:
+    """Thread-safe token bucket that spaces out requests to stay under an API rate limit."""
+
+    def __init__(self, rate: int, period: float):
+        self._capacity = rate
+        self._tokens = float(rate)
+        self._fill_rate = rate / period
+        self._last_fill = monotonic()
+        self._resume_at = 0.0
+        self._lock = Lock()
+
+    def pause(self, seconds: float):
+        """Hold back every caller for the given number of seconds."""
+        with self._lock:
+            self._resume_at = max(self._resume_at, monotonic() + seconds)
+
+    def acquire(self):
+        """Block until a request is allowed, then take its token."""
+        with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._resume_at:
+                    sleep(self._resume_at - now)
+                    continue
+
+                self._tokens = min(self._capacity, self._tokens + (now - self._last_fill) * self._fill_rate)
+                self._last_fill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                sleep((1 - self._tokens) / self._fill_rate)
+
 
 class HackerOneAssetType(Enum):
     """Class representing known types in HackerOne assets."""
@@ -53,7 +115,11 @@ class HackerOneAssetType(Enum):
     OTHER_IPA = "OTHER_IPA"
     TESTFLIGHT = "TESTFLIGHT"
 
-@dataclass
+
+# Plain dict lookup for asset types, skips the Enum call machinery when loading many assets
+_ASSET_TYPES_BY_VALUE = {asset_type.value: asset_type for asset_type in HackerOneAssetType}
+
+@dataclass(eq=False, slots=True)
 class HackerOneAsset:
     """Class representing an asset of a HackerOne Program."""
 
@@ -82,13 +148,15 @@ class HackerOneAsset:
         """Initialize class instance from Dictionary object."""
         return cls(
             asset_dict["id"],
-            HackerOneAssetType(asset_dict["attributes"]["asset_type"]),
+            # Unknown types fall through to the Enum so they still raise ValueError
+            _ASSET_TYPES_BY_VALUE.get(asset_dict["attributes"]["asset_type"])
+            or HackerOneAssetType(asset_dict["attributes"]["asset_type"]),
             asset_dict["attributes"]["asset_identifier"],
             asset_dict["attributes"]["eligible_for_bounty"],
             asset_dict["attributes"]["eligible_for_submission"],
             asset_dict["attributes"]["max_severity"],
-            datetime.fromisoformat(asset_dict["attributes"]["created_at"].rstrip("Z")),
-            datetime.fromisoformat(asset_dict["attributes"]["updated_at"].rstrip("Z")),
+            Utils.parse_naive_datetime(asset_dict["attributes"]["created_at"]),
+            Utils.parse_naive_datetime(asset_dict["attributes"]["updated_at"]),
             asset_dict["attributes"].get("instruction"),
             asset_dict["attributes"].get("reference"),
             asset_dict["attributes"].get("confidentiality_requirement"),
@@ -106,7 +174,7 @@ class HackerOneAsset:
             return True
         return False
 
-@dataclass
+@dataclass(slots=True)
 class HackerOneAttachment:
     """Class representing a single HackerOne Attachment."""
 
@@ -119,32 +187,52 @@ class HackerOneAttachment:
     file_size_bytes: int
     file_size_human: str
     local_path: Path
+    # Shared HTTP session used for downloads, so connections are reused between attachments
+    session: Optional[requests.Session] = field(default=None, repr=False, compare=False)
 
     def __repr__(self) -> str:
         """Pretty representation of class instance."""
         return f"<HackerOneAttachment {self.file_name}, {self.file_size_human}>"
 
-    def download_attachment(self, save_dir_path: Path = Path("/tmp/h1_attachments/")):
-        # Create directory if it doesn't exist
-        if not save_dir_path.exists():
-            save_dir_path.mkdir(parents=True)
+    def download_attachment(self, save_dir_path: Path = Path("/tmp/h1_attachments/"),
+                            session: Optional[requests.Session] = None):
+        # Create directory if it doesn't exist, other downloads may be creating it at the same time
+        save_dir_path.mkdir(parents=True, exist_ok=True)
 
-        # Create full path
+        # Create full path, the download goes to a uniquely named temporary file next to it first
         attachment_full_path = save_dir_path.joinpath(self.file_name)
+        partial_fd, partial_name = tempfile.mkstemp(dir=save_dir_path, prefix=f".{self.id}-", suffix=".part")
+        partial_path = Path(partial_name)
 
-        # Getting file
-        session = requests.session()
-        with session.get(self.expiring_url) as resp:
-            # Open file and save to disk
-            with open(attachment_full_path, 'wb') as f:
-                f.write(resp.content)
+        # Getting file, reusing a keep-alive session when one was provided
+        session = session or self.session or requests.session()
+        try:
+            # The file object owns the descriptor from here on and closes it exactly once
+            with os.fdopen(partial_fd, 'wb') as f:
+                with session.get(self.expiring_url, stream=True) as resp:
+                    # Don't save an error page, e.g. from an expired URL, as if it was the attachment
+                    resp.raise_for_status()
+
+                    # Stream the file to disk, so memory use doesn't grow with the file size
+                    bytes_written = 0
+                    for chunk in resp.iter_content(chunk_size=1 << 16):
+                        bytes_written += f.write(chunk)
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
+
+        # Only a complete download ever shows up under the real file name
+        os.replace(partial_path, attachment_full_path)
 
         self.local_path = save_dir_path
+        # Record the size of what was actually saved
+        self.file_size_bytes = bytes_written
+        self.file_size_human = Utils.sizeof_fmt(bytes_written)
 
         return attachment_full_path
 
     @classmethod
-    def load_from_dict(cls, attachment):
+    def load_from_dict(cls, attachment, session: Optional[requests.Session] = None):
         if attachment["type"] != "attachment":
             raise "The data provided is not type 'attachment'"
 
@@ -155,7 +243,7 @@ class HackerOneAttachment:
 
         attachment_type = attachment["type"],
         expiring_url = attachment["attributes"]["expiring_url"]
-        created_at_dt = datetime.fromisoformat(attachment["attributes"]["created_at"])
+        created_at_dt = Utils.parse_datetime(attachment["attributes"]["created_at"])
         file_name = attachment["attributes"]["file_name"]
         content_type = attachment["attributes"]["content_type"]
         file_size_bytes = attachment["attributes"]["file_size"]
@@ -171,11 +259,23 @@ class HackerOneAttachment:
             content_type,
             file_size_bytes,
             file_size_human,
-            local_path
+            local_path,
+            session
         )
 
 
-@dataclass
+def download_attachments(attachments: Iterable[HackerOneAttachment], save_dir_path: Path,
+                         max_workers: int = 8) -> List[Path]:
+    """Download attachments concurrently and return the saved paths in the same order."""
+    # Downloads are network bound, so threads overlap the waiting instead of paying for each file in turn.
+    # Each attachment gets its own directory, as different comments can attach files with the same name.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda attachment: attachment.download_attachment(save_dir_path=save_dir_path / str(attachment.id)),
+            attachments))
+
+
+@dataclass(slots=True)
 class HackerOneReport:
     """Class representing a single HackerOne Report."""
 
@@ -192,7 +292,8 @@ class HackerOneReport:
     original_report_body: str
     formatted_report_body: str
     reported_datetime: datetime
-    raw_report_dict: dict
+    # Only the activities are kept from the API response, they are needed to find the attachments
+    activities: list
 
     def __repr__(self) -> str:
         """Pretty representation of class instance."""
@@ -239,26 +340,32 @@ class HackerOneReport:
         else:
             raise Exception(f"No report body found")
 
-        report_submitted_dt = datetime.fromisoformat(report["data"]["attributes"]["submitted_at"])
+        report_submitted_dt = Utils.parse_datetime(report["data"]["attributes"]["submitted_at"])
 
+        # Build each URL once, they are used in several fields
+        report_url = f"https://hackerone.com/reports/{report_id}"
+        reporter_url = f"https://hackerone.com/{reporter_username}"
+        formatted_report_body = "\n".join((
+            f"HackerOne Report: {report_url}",
+            f"Report Date: {report_submitted_dt},",
+            f"Reporter URL: {reporter_url}",
+            f"Weakness: {weakness}",
+            report_body,
+        ))
 
         return cls(
             report_id,
             report_title,
             f"[HackerOne] {report_title}",
             reporter_username,
-            f"https://hackerone.com/{reporter_username}",
-            f"[{reporter_username}](https://hackerone.com/{reporter_username})",
+            reporter_url,
+            f"[{reporter_username}]({reporter_url})",
             weakness,
-            f"https://hackerone.com/reports/{report_id}",
+            report_url,
             report_body,
-            (f"HackerOne Report: https://hackerone.com/reports/{report_id}\n"
-                        f"Report Date: {report_submitted_dt},\n"
-                        f"Reporter URL: https://hackerone.com/{reporter_username}\n"
-                        f"Weakness: {weakness}\n"
-                        f"{report_body}"),
+            formatted_report_body,
             report_submitted_dt,
-            report
+            report["data"]["relationships"].get("activities", {}).get("data", [])
         )
 
     def create_bmo_obj(self, bzapi):
@@ -275,7 +382,7 @@ class HackerOneReport:
 
 
 
-@dataclass
+@dataclass(eq=False, slots=True)
 class HackerOneProgram:
     """Class representing a single HackerOne Program."""
 
@@ -332,9 +439,7 @@ class HackerOneProgram:
             program_dict["attributes"]["submission_state"],
             program_dict["attributes"]["triage_active"],
             program_dict["attributes"]["state"],
-            datetime.fromisoformat(
-                program_dict["attributes"]["started_accepting_at"].rstrip("Z")
-            ),
+            Utils.parse_naive_datetime(program_dict["attributes"]["started_accepting_at"]),
             program_dict["attributes"]["number_of_reports_for_user"],
             program_dict["attributes"]["number_of_valid_reports_for_user"],
             program_dict["attributes"]["bounty_earned_for_user"],
@@ -356,11 +461,18 @@ class HackerOneProgram:
         return False
 
 
+# Activities that may have attachments
+# I don't think we want to import "activity-report-triage-summary-created" as that would be a repeat of the original
+# report
+_ATTACHMENT_ACTIVITY_TYPES = frozenset({"activity-comment"})
+
+
 class HackerOneSession:
     """Class to interact with the Hacker API of HackerOne."""
 
-    def __init__(self, username, token, console, version="v1", local_cache_path: Path = Path("/tmp/h1_cache"),
-                 cache: bool = False, retry_time: int = 5):
+    def __init__(self, username, token, console, version="v1", local_cache_path: Path = Path("/tmp/h1_cache.d"),
+                 cache: bool = False, retry_time: int = 5, max_retry_time: int = 60, rate_limit: int = 600,
+                 rate_limit_period: int = 60):
         self._session = requests.session()
         self.version = version
 
@@ -370,53 +482,124 @@ class HackerOneSession:
         }
         self._session.auth = (username, token)
         self._session.headers.update(headers)
+        # Attachments are served from pre-signed URLs on another host, so they get their own session without the
+        # API credentials
+        self._download_session = requests.session()
+        # Expiring URLs are flaky now and then, retry them with backoff instead of failing the whole upload
+        self._download_session.mount("https://", HTTPAdapter(
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))))
         self._console = console
         self._local_cache_path = local_cache_path
         self._cache = cache
         self._retry_time = retry_time
+        self._max_retry_time = max_retry_time
+        # HackerOne allows 600 read requests per minute
+        self._limiter = RateLimiter(rate=rate_limit, period=rate_limit_period)
 
     def _get(self, endpoint, params: dict = None):
         """Retrieve a HTTP GET endpoint."""
         url = self._url(endpoint)
 
         # Retry loop
+        attempt = 0
         while True:
+            self._limiter.acquire()
             response = self._session.get(url, params=params)
+            self._check_rate_limit(response)
             if response.status_code == 200:
-                return response.json()
+                return orjson.loads(response.content)
             elif response.status_code == 403:
                 self._console.print(f"{error_msg} Permission denied. That report is not accessable with this API key. HTTP Error {int(403)}")
                 sys.exit(1)
+            elif response.status_code == 429 or response.status_code >= 500:
+                retry_time = self._retry_delay(response, attempt)
+                self._console.print(f"{info_msg} Got error {response.status_code} back, retrying in {retry_time:.1f} seconds")
+                if response.status_code in (429, 503):
+                    # The server wants us to slow down, so hold back every request and not just this one
+                    self._limiter.pause(retry_time)
+                sleep(retry_time)
+                attempt += 1
             else:
-                self._console.print(f"{info_msg} Got error {response.status_code} back, retrying in {self._retry_time} seconds")
-                sleep(self._retry_time)
+                # Other client errors won't go away by retrying
+                self._console.print(f"{error_msg} Request to {url} failed. HTTP Error {response.status_code}")
+                sys.exit(1)
+
+    def _check_rate_limit(self, response: requests.Response):
+        """Pause all requests until the rate limit window resets when the server says we have used it up."""
+        if response.headers.get("X-RateLimit-Remaining") != "0":
+            return
+
+        reset = response.headers.get("X-RateLimit-Reset", "")
+        if reset.isdigit():
+            reset_seconds = int(reset)
+            # The reset header is either a UNIX timestamp or a number of seconds from now
+            if reset_seconds > time():
+                reset_seconds -= time()
+            self._limiter.pause(reset_seconds)
+
+    def _retry_delay(self, response: requests.Response, attempt: int) -> float:
+        """Seconds to wait before retrying a failed request."""
+        # Honor the server when it tells us how long to wait
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            # Capped, as the wait pauses every request and not just this one
+            return min(self._max_retry_time, float(retry_after))
+
+        # Otherwise back off exponentially, with jitter so parallel requests don't retry in lockstep
+        return min(self._max_retry_time, self._retry_time * 2 ** attempt) + random.uniform(0, 1)
 
     def _url(self, endpoint) -> str:
         """Generate full API url."""
         url = f"https://api.hackerone.com/{self.version}/{endpoint}"
         return url
 
-    def list_programs(self) -> Set[HackerOneProgram]:
+    @staticmethod
+    def _last_page_number(response: dict) -> Optional[int]:
+        """Read the last page number from the pagination links of a response, if there is one."""
+        last_url = response.get("links", {}).get("last")
+        if not last_url:
+            return None
+
+        page_number = parse_qs(urlparse(last_url).query).get("page[number]")
+        if not page_number or not page_number[0].isdigit():
+            return None
+        return int(page_number[0])
+
+    def list_programs(self, max_workers: int = 8) -> Set[HackerOneProgram]:
         """Retrieve a list of programs."""
         endpoint = "programs"
 
         programs = set()
 
+        # The first page tells us how many pages there are, so the rest can be fetched at the same time
+        response = self._get(endpoint, params={"page[number]": 1})
+        last_page_number = self._last_page_number(response)
+        if last_page_number is not None:
+            programs.update(HackerOneProgram.load_from_dict(program) for program in response.get("data", []))
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pages = executor.map(lambda number: self._get(endpoint, params={"page[number]": number}),
+                                     range(2, last_page_number + 1))
+                for page in pages:
+                    programs.update(HackerOneProgram.load_from_dict(program) for program in page.get("data", []))
+
+            return programs
+
+        # Without a link to the last page, follow the next links one page at a time
         page_number = 1
         while True:
-            response = self._get(endpoint, params={"page[number]": page_number})
+            data = response.get("data")
+            if not data:
+                break
+
+            # Keep the page before deciding whether there is another one, so the last page isn't lost
+            programs.update(HackerOneProgram.load_from_dict(program) for program in data)
 
-            if not response["links"].get("next") or not response.get("data"):
+            if not response.get("links", {}).get("next"):
                 break
-            else:
-                page_number += 1
 
-                programs.update(
-                    [
-                        HackerOneProgram.load_from_dict(program)
-                        for program in response["data"]
-                    ]
-                )
+            page_number += 1
+            response = self._get(endpoint, params={"page[number]": page_number})
 
         return programs
 
@@ -453,71 +636,49 @@ class HackerOneSession:
         # For development, caching can be enabled to not be banned for too many requests of the same report over and over
         endpoint = f"reports/{report_id}"
 
-        if self._local_cache_path.exists() and self._cache:
-            # Path exists and caching is desired
-            self._console.print(f"{info_msg} Using the local cache")
-            with open(self._local_cache_path, 'rb') as f:
-                report_dict = pickle.load(f)
-
-            if report_id not in report_dict:
-                # Get the report if missing
-                self._console.print(f"{info_msg} Local cache found, report ID not found, getting")
-                report = self._get(endpoint)
-
-                # Add to cache
-                report_dict = {report_id: report}
-                # Write report to pickle
-                with open(self._local_cache_path, 'wb') as f:
-                    pickle.dump(report_dict, f)
-                return HackerOneReport.load_from_dict(report=report_dict[report_id])
+        # The local cache is a directory holding the raw JSON of each report, so a lookup only reads the report it
+        # needs
+        report_cache_path = self._local_cache_path / f"{report_id}.json"
 
+        if not self._cache:
+            # Local caching set to false
+            return HackerOneReport.load_from_dict(report=self._get(endpoint))
+
+        if report_cache_path.exists():
+            try:
+                report = orjson.loads(report_cache_path.read_bytes())
+            except orjson.JSONDecodeError:
+                # A damaged cache entry is treated as missing and gets replaced below
+                self._console.print(f"{info_msg} Cached report could not be read, getting it again")
             else:
                 self._console.print(f"{success_msg} Report found in local cache")
-                return HackerOneReport.load_from_dict(report=report_dict[report_id])
-        elif not self._local_cache_path.exists() and self._cache:
-            # Path does not exist and caching is desired
-            if self._cache:
-                self._console.print(f"{info_msg} Local cache doesn't exist but it is desired, contacting server to warm up the cache")
-            report = self._get(endpoint)
-            # Add to cache
-            report_dict = {report_id: report}
-
-            # Write report to pickle
-            with open(self._local_cache_path, 'wb') as f:
-                pickle.dump(report_dict, f)
-            return HackerOneReport.load_from_dict(report=report_dict[report_id])
-
-        elif not self._cache:
-            # Local caching set to false
-            report = self._get(endpoint)
-            # Add to cache
-            report_dict = {report_id: report}
-            return HackerOneReport.load_from_dict(report=report_dict[report_id])
+                return HackerOneReport.load_from_dict(report=report)
+
+        # Report is not cached yet and caching is desired
+        self._console.print(f"{info_msg} Report ID not found in the local cache, contacting server to warm up the cache")
+        report = self._get(endpoint)
+
+        # Write only this report to its own file, through a temporary file so an interrupted write never leaves a
+        # truncated report behind
+        self._local_cache_path.mkdir(parents=True, exist_ok=True)
+        partial_fd, partial_name = tempfile.mkstemp(dir=self._local_cache_path, prefix=f".{report_id}-",
+                                                    suffix=".part")
+        try:
+            with os.fdopen(partial_fd, 'wb') as f:
+                f.write(orjson.dumps(report))
+        except BaseException:
+            Path(partial_name).unlink(missing_ok=True)
+            raise
+        os.replace(partial_name, report_cache_path)
+        return HackerOneReport.load_from_dict(report=report)
 
     def get_attachments(self, report: HackerOneReport) -> [HackerOneAttachment]:
         """Get all attachment information in a report"""
-        attachments_list = list()
-        raw_dict = report.raw_report_dict
-        attachment_list = list()
-
-        # Get attachments for each comment
-        for activity in raw_dict["data"]["relationships"]["activities"]["data"]:
-
-            # Activities that may have attachements
-            # I don't think we want to import "activity-report-triage-summary-created" as that would be a repeat of
-            # the original report
-            attachment_activity_types = ["activity-comment"]
-            if activity["type"] in attachment_activity_types:
-                # If the activity is 'internal', ignore it as we likely won't need to grab attachments from internal
-                # comments
-                message = activity["attributes"]["message"]
-
-                # If internal is False
-                if not activity["attributes"]["internal"]:
-                    # If there's an attachment
-                    if "attachments" in activity["relationships"]:
-                        for attachment in activity["relationships"]["attachments"]["data"]:
-                            h1_attachement = HackerOneAttachment.load_from_dict(attachment)
-                            attachment_list.append(h1_attachement)
-
-        return attachment_list
+        # Get attachments for each comment, skipping 'internal' ones as we likely won't need to grab attachments from
+        # internal comments
+        return [
+            HackerOneAttachment.load_from_dict(attachment, session=self._download_session)
+            for activity in report.activities
+            if activity["type"] in _ATTACHMENT_ACTIVITY_TYPES and not activity["attributes"]["internal"]
+            for attachment in activity.get("relationships", {}).get("attachments", {}).get("data", ())
+        ]